@@ -1,11 +1,23 @@
+import asyncio
+import hashlib
+import itertools
+import logging
 import os
-from typing import Optional, List
+from contextlib import asynccontextmanager
+from typing import Optional, List, Union
 from uuid import UUID
 from dotenv import load_dotenv
-from fastapi import FastAPI, Depends, Header, HTTPException, status
+from fastapi import FastAPI, Depends, Header, HTTPException, Request, status
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
+from fastapi.responses import ORJSONResponse, Response
+from fastapi_cache import FastAPICache
+from fastapi_cache.backends.inmemory import InMemoryBackend
+from fastapi_cache.backends.redis import RedisBackend
+from fastapi_cache.decorator import cache
+from pydantic import BaseModel, Field, TypeAdapter
+from redis import asyncio as aioredis
 import httpx
+import orjson
 import uvicorn
 
 load_dotenv()
@@ -13,15 +25,85 @@ load_dotenv()
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 ANON_KEY = os.getenv("SUPABASE_ANON_KEY")
 TABLE = os.getenv("TABLE_VTUBERS", "vtubers")
+AGENCIES_VIEW = os.getenv("VIEW_AGENCIES", "distinct_agencies")
+SEARCH_RPC_PATH = f"rpc/{os.getenv('RPC_SEARCH_VTUBERS', 'search_vtubers')}"
 POSTGREST_URL = f"{SUPABASE_URL}/rest/v1"
+REDIS_URL = os.getenv("REDIS_URL")
+# Only an explicit worker count is trusted here; uvicorn, gunicorn or tests may import the app without __main__
+WEB_CONCURRENCY = os.getenv("WEB_CONCURRENCY")
+CACHE_BACKEND = os.getenv("CACHE_BACKEND") or (
+    "redis" if REDIS_URL else "memory" if WEB_CONCURRENCY == "1" else "off"
+)
+LIST_COLUMNS = "id,name,agency,debut_date,image_url,created_at,updated_at"
+MAX_CONNECTIONS = 100
+BULK_CONCURRENCY = 32
+CACHE_PREFIX = "vt"
+CACHE_NAMESPACE = "vtubers"
 
 if not SUPABASE_URL or not ANON_KEY:
     raise RuntimeError("SUPABASE_URL or SUPABASE_ANON_KEY not found.")
 
+if CACHE_BACKEND not in ("redis", "memory", "off"):
+    raise RuntimeError("CACHE_BACKEND must be one of: redis, memory, off.")
+
+if CACHE_BACKEND == "redis" and not REDIS_URL:
+    raise RuntimeError("CACHE_BACKEND=redis requires REDIS_URL.")
+
+logger = logging.getLogger("uvicorn.error")
+
+# Caps in-flight Supabase requests per worker at the pool size
+OUTBOUND = asyncio.Semaphore(MAX_CONNECTIONS)
+
+# Shared by every Supabase request; httpx copies headers, so this is never mutated
+PUBLIC_HEADERS = {
+    "apikey": ANON_KEY,
+    "Content-Type": "application/json",
+    "Accept": "application/json",
+    "Prefer": "return=representation",
+}
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Set up the response cache and one pooled Supabase client shared by all requests"""
+    redis = None
+    if CACHE_BACKEND == "redis":
+        redis = aioredis.from_url(REDIS_URL)
+        FastAPICache.init(RedisBackend(redis), prefix=CACHE_PREFIX)
+    elif CACHE_BACKEND == "memory":
+        FastAPICache.init(InMemoryBackend(), prefix=CACHE_PREFIX)
+    else:
+        if not os.getenv("CACHE_BACKEND"):
+            # Per-process caches can't be invalidated across workers, so without a known single worker serve uncached
+            logger.warning(
+                "Response caching disabled: REDIS_URL is not set and WEB_CONCURRENCY is %s. "
+                "Set CACHE_BACKEND=memory when running a single process, or REDIS_URL to share the cache.",
+                f"set to {WEB_CONCURRENCY!r}" if WEB_CONCURRENCY else "not set"
+            )
+        FastAPICache.init(InMemoryBackend(), prefix=CACHE_PREFIX, enable=False)
+    
+    app.state.client = httpx.AsyncClient(
+        base_url=f"{POSTGREST_URL}/",  # handlers pass paths relative to this, parsed once here
+        timeout=10,
+        http2=True,
+        limits=httpx.Limits(
+            max_connections=MAX_CONNECTIONS,
+            max_keepalive_connections=50,
+            keepalive_expiry=30,
+        ),
+    )
+    try:
+        yield
+    finally:
+        await app.state.client.aclose()
+        if redis is not None:
+            await redis.aclose()
+
 app = FastAPI(
     title="VTuber Wiki API",
     description="A public API for VTuber information and profiles",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
 # Add CORS middleware for Postman testing
@@ -67,9 +149,24 @@ class VTuberOut(BaseModel):
     created_at: str
     updated_at: str
 
+class VTuberListOut(BaseModel):
+    id: UUID
+    name: str
+    agency: Optional[str]
+    debut_date: Optional[str]
+    image_url: Optional[str]
+    created_at: str
+    updated_at: str
+
+# Serializes a list of VTuberCreate straight to JSON bytes
+VTUBER_CREATE_LIST = TypeAdapter(List[VTuberCreate])
+
 class VTuberBulkCreate(BaseModel):
     vtubers: List[VTuberCreate]
 
+class BulkInsertSummary(BaseModel):
+    inserted: int
+
 # Authentication dependencies
 async def get_user_token(authorization: Optional[str] = Header(default=None)):
     """Required for write operations"""
@@ -80,17 +177,32 @@ async def get_user_token(authorization: Optional[str] = Header(default=None)):
         )
     return authorization
 
+def get_client(request: Request) -> httpx.AsyncClient:
+    """Shared Supabase client created in lifespan"""
+    return request.app.state.client
+
+def cache_key_builder(func, namespace: str = "", *, request=None, response=None, args=(), kwargs=None):
+    """Cache key from the endpoint arguments, ignoring the injected client"""
+    params = sorted((k, v) for k, v in (kwargs or {}).items() if k != "client")
+    return f"{namespace}:{func.__name__}:{params}"
+
+async def invalidate_cache():
+    """Drop cached public responses after a write"""
+    await FastAPICache.clear(namespace=CACHE_NAMESPACE)
+
+def ilike_contains(q: str) -> str:
+    """Quoted PostgREST ilike value that matches q literally anywhere in the column"""
+    # Escape LIKE wildcards for Postgres, then backslashes and quotes for the quoted PostgREST value.
+    # PostgREST has no escape for *, so a * in q still acts as a wildcard.
+    q = q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    q = q.replace("\\", "\\\\").replace('"', '\\"')
+    return f'"*{q}*"'
+
 def postgrest_headers(user_authorization: Optional[str] = None):
     """Headers for Supabase requests"""
-    headers = {
-        "apikey": ANON_KEY,
-        "Content-Type": "application/json",
-        "Accept": "application/json",
-        "Prefer": "return=representation",
-    }
     if user_authorization:
-        headers["Authorization"] = user_authorization
-    return headers
+        return {**PUBLIC_HEADERS, "Authorization": user_authorization}
+    return PUBLIC_HEADERS
 
 # Public endpoints (no authentication required)
 @app.get("/")
@@ -119,16 +231,18 @@ async def root():
 async def health():
     return {"status": "ok", "service": "VTuber Wiki API"}
 
-@app.get("/vtubers", response_model=List[VTuberOut])
+@app.get("/vtubers", response_model=None, responses={200: {"model": List[VTuberListOut]}})
+@cache(expire=300, namespace=CACHE_NAMESPACE, key_builder=cache_key_builder)
 async def list_vtubers(
     limit: int = 50,
     offset: int = 0,
     agency: Optional[str] = None,
-    sort_by: str = "name"
+    sort_by: str = "name",
+    client: httpx.AsyncClient = Depends(get_client)
 ):
     """Get all VTubers (public endpoint)"""
     params = {
-        "select": "*",
+        "select": LIST_COLUMNS,
         "limit": str(min(limit, 100)),
         "offset": str(max(offset, 0)),
         "order": f"{sort_by}.asc"
@@ -137,25 +251,29 @@ async def list_vtubers(
     if agency:
         params["agency"] = f"eq.{agency}"
     
-    async with httpx.AsyncClient(timeout=10) as client:
+    async with OUTBOUND:
         r = await client.get(
-            f"{POSTGREST_URL}/{TABLE}",
+            TABLE,
             headers=postgrest_headers(),  # No auth required
             params=params
         )
     
     if r.status_code >= 400:
         raise HTTPException(r.status_code, r.text)
-    return r.json()
+    return orjson.loads(r.content)
 
-@app.get("/vtubers/{vtuber_id}", response_model=List[VTuberOut])
-async def get_vtuber(vtuber_id: UUID):
+@app.get("/vtubers/{vtuber_id}", response_model=None, responses={200: {"model": List[VTuberOut]}})
+async def get_vtuber(
+    vtuber_id: UUID,
+    request: Request,
+    client: httpx.AsyncClient = Depends(get_client)
+):
     """Get specific VTuber by ID (public endpoint)"""
-    params = {"select": "*", "id": f"eq.{vtuber_id}"}
+    params = [("select", "*"), ("id", f"eq.{vtuber_id}")]
     
-    async with httpx.AsyncClient(timeout=10) as client:
+    async with OUTBOUND:
         r = await client.get(
-            f"{POSTGREST_URL}/{TABLE}",
+            TABLE,
             headers=postgrest_headers(),  # No auth required
             params=params
         )
@@ -163,142 +281,246 @@ async def get_vtuber(vtuber_id: UUID):
     if r.status_code >= 400:
         raise HTTPException(r.status_code, r.text)
     
-    result = r.json()
+    result = orjson.loads(r.content)
     if not result:
         raise HTTPException(status_code=404, detail="VTuber not found")
-    return result
+    
+    # Hash the row itself so the tag changes on any edit, even if updated_at does not
+    etag = f'W/"{hashlib.blake2b(r.content, digest_size=16).hexdigest()}"'
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=60"}
+    if_none_match = request.headers.get("If-None-Match", "")
+    if etag in (tag.strip() for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers=headers)
+    return ORJSONResponse(result, headers=headers)
 
-@app.get("/search", response_model=List[VTuberOut])
+@app.get("/search", response_model=None, responses={200: {"model": List[VTuberOut]}})
+@cache(expire=600, namespace=CACHE_NAMESPACE, key_builder=cache_key_builder)
 async def search_vtubers(
     q: str,
     limit: int = 20,
-    offset: int = 0
+    offset: int = 0,
+    client: httpx.AsyncClient = Depends(get_client)
 ):
     """Search VTubers by name or description (public endpoint)"""
-    params = {
-        "select": "*",
-        "limit": str(min(limit, 50)),
-        "offset": str(max(offset, 0)),
-        "or": f"(name.ilike.*{q}*,description.ilike.*{q}*)"
+    body = {
+        "q": q,
+        "lim": min(limit, 50),
+        "off": max(offset, 0)
     }
     
-    async with httpx.AsyncClient(timeout=10) as client:
-        r = await client.get(
-            f"{POSTGREST_URL}/{TABLE}",
+    async with OUTBOUND:
+        r = await client.post(
+            SEARCH_RPC_PATH,
             headers=postgrest_headers(),  # No auth required
-            params=params
+            content=orjson.dumps(body)
         )
     
+    # Without the RPC, filter the table directly with q quoted so it can't break the or= syntax
+    if r.status_code == 404:
+        pattern = ilike_contains(q)
+        params = {
+            "select": "*",
+            "limit": str(body["lim"]),
+            "offset": str(body["off"]),
+            "or": f"(name.ilike.{pattern},description.ilike.{pattern})"
+        }
+        async with OUTBOUND:
+            r = await client.get(
+                TABLE,
+                headers=postgrest_headers(),  # No auth required
+                params=params
+            )
+    
     if r.status_code >= 400:
         raise HTTPException(r.status_code, r.text)
-    return r.json()
+    return orjson.loads(r.content)
 
 @app.get("/agencies")
-async def list_agencies():
+@cache(expire=300, namespace=CACHE_NAMESPACE, key_builder=cache_key_builder)
+async def list_agencies(client: httpx.AsyncClient = Depends(get_client)):
     """Get list of all agencies (public endpoint)"""
     params = {
         "select": "agency",
-        "agency": "not.is.null",
         "order": "agency.asc"
     }
     
-    async with httpx.AsyncClient(timeout=10) as client:
+    async with OUTBOUND:
         r = await client.get(
-            f"{POSTGREST_URL}/{TABLE}",
+            AGENCIES_VIEW,
             headers=postgrest_headers(),  # No auth required
             params=params
         )
     
+    # Without the view, read the agency column ordered by PostgREST and collapse runs of duplicates
+    if r.status_code == 404:
+        params["agency"] = "not.is.null"
+        async with OUTBOUND:
+            r = await client.get(
+                TABLE,
+                headers=postgrest_headers(),  # No auth required
+                params=params
+            )
+    
     if r.status_code >= 400:
         raise HTTPException(r.status_code, r.text)
     
-    agencies = list(set([item["agency"] for item in r.json() if item["agency"]]))
-    return {"agencies": sorted(agencies)}
+    agencies = (item["agency"] for item in orjson.loads(r.content) if item["agency"])
+    return {"agencies": [agency for agency, _ in itertools.groupby(agencies)]}
 
 # Protected endpoints (require authentication)
 @app.post("/vtubers", response_model=List[VTuberOut], status_code=201)
-async def create_vtuber(payload: VTuberCreate, auth=Depends(get_user_token)):
+async def create_vtuber(
+    payload: VTuberCreate,
+    auth=Depends(get_user_token),
+    client: httpx.AsyncClient = Depends(get_client)
+):
     """Create a new VTuber entry (requires authentication)"""
-    async with httpx.AsyncClient(timeout=10) as client:
+    async with OUTBOUND:
         r = await client.post(
-            f"{POSTGREST_URL}/{TABLE}",
+            TABLE,
             headers=postgrest_headers(auth),
-            json=payload.model_dump(mode="json")
+            content=payload.model_dump_json().encode()
         )
         
     if r.status_code >= 400:
         raise HTTPException(r.status_code, r.text)
-    return r.json()
+    await invalidate_cache()
+    return orjson.loads(r.content)
 
-@app.post("/vtubers/bulk", response_model=List[VTuberOut], status_code=201)
-async def create_vtubers_bulk(payload: VTuberBulkCreate, auth=Depends(get_user_token)):
-    """Create multiple VTubers in bulk (requires authentication)"""
-    async with httpx.AsyncClient(timeout=30) as client:
-        results = []
-        for vtuber_data in payload.vtubers:
-            r = await client.post(
-                f"{POSTGREST_URL}/{TABLE}",
-                headers=postgrest_headers(auth),
-                json=vtuber_data.model_dump(mode="json")
+async def insert_vtubers(client: httpx.AsyncClient, auth: str, vtubers: List[VTuberCreate], echo: bool = True):
+    """Insert many VTubers with a single PostgREST array insert (returns a count when echo is off)"""
+    if not vtubers:
+        return [] if echo else 0
+    
+    headers = postgrest_headers(auth)
+    if not echo:
+        headers = {**headers, "Prefer": "return=minimal"}
+    
+    async with OUTBOUND:
+        r = await client.post(
+            TABLE,
+            headers=headers,
+            content=VTUBER_CREATE_LIST.dump_json(vtubers),
+            timeout=30
+        )
+    
+    # A single bad row rejects the whole statement; retry row by row and skip failures
+    if r.status_code in (400, 409):
+        return await insert_vtubers_each(client, headers, vtubers, echo)
+    if r.status_code >= 400:
+        raise HTTPException(r.status_code, r.text)
+    return orjson.loads(r.content) if echo else len(vtubers)
+
+async def insert_vtubers_each(client: httpx.AsyncClient, headers: dict, vtubers: List[VTuberCreate], echo: bool = True):
+    """Insert VTubers one per request concurrently, skipping rows that fail"""
+    sem = asyncio.Semaphore(BULK_CONCURRENCY)
+    
+    async def insert_one(vtuber_data: VTuberCreate):
+        async with sem, OUTBOUND:
+            return await client.post(
+                TABLE,
+                headers=headers,
+                content=vtuber_data.model_dump_json().encode(),
+                timeout=30
             )
-            if r.status_code >= 400:
-                continue
-            results.extend(r.json())
-        return results
+    
+    responses = await asyncio.gather(
+        *[insert_one(vtuber_data) for vtuber_data in vtubers],
+        return_exceptions=True
+    )
+    
+    inserted = [r for r in responses if isinstance(r, httpx.Response) and r.status_code < 400]
+    if not echo:
+        return len(inserted)
+    
+    results = []
+    for r in inserted:
+        results.extend(orjson.loads(r.content))
+    return results
 
-@app.post("/vtubers/batch", response_model=List[VTuberOut], status_code=201)
-async def create_vtubers_batch(vtubers: List[VTuberCreate], auth=Depends(get_user_token)):
+@app.post("/vtubers/bulk", response_model=Union[List[VTuberOut], BulkInsertSummary], status_code=201)
+async def create_vtubers_bulk(
+    payload: VTuberBulkCreate,
+    echo: bool = True,
+    auth=Depends(get_user_token),
+    client: httpx.AsyncClient = Depends(get_client)
+):
+    """Create multiple VTubers in bulk (requires authentication)"""
+    results = await insert_vtubers(client, auth, payload.vtubers, echo)
+    await invalidate_cache()
+    return results if echo else {"inserted": results}
+
+@app.post("/vtubers/batch", response_model=Union[List[VTuberOut], BulkInsertSummary], status_code=201)
+async def create_vtubers_batch(
+    vtubers: List[VTuberCreate],
+    echo: bool = True,
+    auth=Depends(get_user_token),
+    client: httpx.AsyncClient = Depends(get_client)
+):
     """Create multiple VTubers in batch (direct array format) (requires authentication)"""
-    async with httpx.AsyncClient(timeout=30) as client:
-        results = []
-        for vtuber_data in vtubers:
-            r = await client.post(
-                f"{POSTGREST_URL}/{TABLE}",
-                headers=postgrest_headers(auth),
-                json=vtuber_data.model_dump(mode="json")
-            )
-            if r.status_code >= 400:
-                continue
-            results.extend(r.json())
-        return results
+    results = await insert_vtubers(client, auth, vtubers, echo)
+    await invalidate_cache()
+    return results if echo else {"inserted": results}
 
 @app.put("/vtubers/{vtuber_id}", response_model=List[VTuberOut])
-async def update_vtuber(vtuber_id: UUID, payload: VTuberUpdate, auth=Depends(get_user_token)):
+async def update_vtuber(
+    vtuber_id: UUID,
+    payload: VTuberUpdate,
+    auth=Depends(get_user_token),
+    client: httpx.AsyncClient = Depends(get_client)
+):
     """Update VTuber information (requires authentication)"""
-    data = {k: v for k, v in payload.model_dump(mode="json").items() if v is not None}
+    data = payload.model_dump(mode="json", exclude_none=True)
     
     if not data:
         raise HTTPException(400, "No fields to update")
     
-    async with httpx.AsyncClient(timeout=10) as client:
+    async with OUTBOUND:
         r = await client.patch(
-            f"{POSTGREST_URL}/{TABLE}",
+            TABLE,
             headers=postgrest_headers(auth),
-            params={"id": f"eq.{vtuber_id}"},
-            json=data,
+            params=[("id", f"eq.{vtuber_id}")],
+            content=orjson.dumps(data),
         )
     
     if r.status_code >= 400:
         raise HTTPException(r.status_code, r.text)
     
-    result = r.json()
+    result = orjson.loads(r.content)
     if not result:
         raise HTTPException(status_code=404, detail="VTuber not found")
+    await invalidate_cache()
     return result
 
 @app.delete("/vtubers/{vtuber_id}", status_code=204)
-async def delete_vtuber(vtuber_id: UUID, auth=Depends(get_user_token)):
+async def delete_vtuber(
+    vtuber_id: UUID,
+    auth=Depends(get_user_token),
+    client: httpx.AsyncClient = Depends(get_client)
+):
     """Delete a VTuber entry (requires authentication)"""
-    async with httpx.AsyncClient(timeout=10) as client:
+    async with OUTBOUND:
         r = await client.delete(
-            f"{POSTGREST_URL}/{TABLE}",
+            TABLE,
             headers=postgrest_headers(auth),
-            params={"id": f"eq.{vtuber_id}"},
+            params=[("id", f"eq.{vtuber_id}")],
         )
     
     if r.status_code >= 400:
         raise HTTPException(r.status_code, r.text)
+    await invalidate_cache()
     return {}
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    workers = int(WEB_CONCURRENCY or os.cpu_count() or 1)
+    # Workers import main:app fresh, so this tells them the real count when picking a cache backend
+    os.environ["WEB_CONCURRENCY"] = str(workers)
+    uvicorn.run(
+        "main:app",  # import string is required when workers > 1
+        host="0.0.0.0",
+        port=8000,
+        workers=workers,
+        loop="auto",  # uvloop when installed
+        http="httptools",
+        access_log=False
+    )
\ No newline at end of file